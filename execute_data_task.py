@@ -1,14 +1,32 @@
+import argparse
 import datetime as dt
 import logging
-import shelve
+import os
+import types
 
 import numpy as np
 import pandas as pd
+import pyarrow.json as paj
+
+from mappers import COLOR_MAPPER, MAIN_MAPPER
 
 PATH_SUP = "data/supplier_car.json"
 PATH_TARGET = "data/target_data.xlsx"
-PATH_MAPPERS = "data/mapper_dicts"
 
+PANDAS_VERSION = tuple(int(x) for x in pd.__version__.split(".")[:2])
+
+# pandas knows the calamine engine from version 2.2 on only
+try:
+    import python_calamine  # noqa: F401
+
+    EXCEL_ENGINE = "calamine" if PANDAS_VERSION >= (2, 2) else "openpyxl"
+except ImportError:
+    EXCEL_ENGINE = "openpyxl"
+
+# Copies are only made when a shared frame is actually written to
+# (this is the default behavior from pandas 3 on)
+if PANDAS_VERSION < (3, 0):
+    pd.set_option("mode.copy_on_write", True)
 
 logging.basicConfig(
     level=logging.INFO,
@@ -19,83 +37,124 @@ logging.basicConfig(
 
 def load_json_supplier_data(path):
     """Read supplier data into a dataframe, replace "null"
-    values with np.nan. Note: The JSON is in line format.
+    values with np.nan. Note: The JSON is in line format, which
+    is exactly what the pyarrow reader expects.
     """
-    df = pd.read_json(path, lines=True)
-    df.replace("null", np.nan, inplace=True)
+    df = paj.read_json(path).to_pandas()
+    # Only string columns can hold the "null" sentinel
+    str_cols = df.select_dtypes(include=["object", "string"]).columns
+    df[str_cols] = df[str_cols].mask(df[str_cols] == "null")
+    # The key columns repeat for every attribute of an entity
+    key_cols = [
+        "MakeText",
+        "TypeName",
+        "TypeNameFull",
+        "ModelText",
+        "ModelTypeText",
+        "Attribute Names",
+    ]
+    df[key_cols] = df[key_cols].astype("category")
     return df
 
 
-def load_excel_target_data(path, engine="openpyxl"):
+def load_excel_target_data(path, engine=EXCEL_ENGINE):
     """Read target data into dataframe, I will use it to generate
-    several mapping dicts. Note: I use the openpyxl engine here.
-    You can change that and use another like xlread or so.
+    several mapping dicts. Note: I use the (Rust based) calamine
+    engine here if it is installed, openpyxl otherwise. You can
+    change that and use another like xlread or so.
+    The parsed data is cached to a parquet file next to the Excel
+    file, it is used as long as it is newer than the Excel file.
     """
+    path_cache = f"{path}.parquet"
+    if os.path.exists(path_cache) and (
+        os.path.getmtime(path_cache) >= os.path.getmtime(path)
+    ):
+        return pd.read_parquet(path_cache)
+
     df_target = pd.read_excel(path, engine=engine)
+    # Write to a temp file first, so that a failed write never leaves a
+    # partial cache behind (it would be newer than the Excel file)
+    path_tmp = f"{path_cache}.tmp"
+    try:
+        df_target.to_parquet(path_tmp, index=False)
+        os.replace(path_tmp, path_cache)
+    except (ValueError, TypeError, OSError) as e:
+        # E.g. mixed type columns, a read-only directory or a full disk
+        logging.warning(f"Target data could not be cached: {e}")
+        if os.path.exists(path_tmp):
+            os.remove(path_tmp)
     return df_target
 
 
-def load_prepared_mapping_dicts(path):
+def load_prepared_mapping_dicts():
     """Load two prepared dictionaries. One is the quasi-mythical
     "MAIN MAPPER", defining which columns of the target data
     correspond to which columns of the supplier data. The other
     is a simple color mapper (german to english).
-    (See DEV jupyter notebook for the dictionary definition.)
+    (See the `mappers` module for the dictionary definition.)
+    Note: The dicts are returned as read-only views so the
+    module-level values cannot be altered.
     """
-    with shelve.open(path, "r") as shelf:
-        main_mapper = shelf["main_mapper"]
-        color_mapper = shelf["color_mapper"]
-        return main_mapper, color_mapper
+    return types.MappingProxyType(MAIN_MAPPER), types.MappingProxyType(COLOR_MAPPER)
 
 
 def pivot_attributes_of_supplier_data(df):
     """Pivot the `Attribute Names` and `Attribute Values` columns to
-    bring the df into a tidy format (1 row per entity). Note: You
-    have to make sure you have no missing values in the index columns!
+    bring the df into a tidy format (1 row per entity). Note: The
+    index columns are determined by the `ID`, so they are taken from
+    the first row of each entity and can contain missing values.
     """
-    # Replace the nan values temporarily with a placeholder for the pivot
-    df = df.fillna("xxx").copy()
-    df = df.pivot_table(
-        index=[
-            "ID",
-            "MakeText",
-            "TypeName",
-            "TypeNameFull",
-            "ModelText",
-            "ModelTypeText",
-        ],
-        columns="Attribute Names",
-        values="Attribute Values",
-        aggfunc="max",
-    ).reset_index()
-    df.columns.name = None
-    df = df.replace("xxx", np.nan)
+    # The key columns are loaded as categoricals, pass them on as plain values
+    keys = df.drop_duplicates("ID").set_index("ID")[
+        ["MakeText", "TypeName", "TypeNameFull", "ModelText", "ModelTypeText"]
+    ].sort_index().astype(object)
+    id_codes, ids = pd.factorize(df["ID"], sort=True)
+    # Factorize before dropping the missing values, so that attributes
+    # without any value still get their (empty) column
+    attr_codes, attr_names = pd.factorize(df["Attribute Names"], sort=True)
+    has_value = (attr_codes != -1) & df["Attribute Values"].notna().to_numpy()
+    id_codes, attr_codes = id_codes[has_value], attr_codes[has_value]
+    values = df["Attribute Values"].to_numpy(dtype=object)[has_value]
+
+    pivoted = np.full((len(ids), len(attr_names)), np.nan, dtype=object)
+    if len(values) > 0:
+        # Sort by (ID, attribute) so that every pair forms a contiguous run
+        order = np.lexsort((attr_codes, id_codes))
+        id_codes, attr_codes = id_codes[order], attr_codes[order]
+        values = values[order]
+        starts = np.flatnonzero(
+            np.r_[
+                True,
+                (id_codes[1:] != id_codes[:-1]) | (attr_codes[1:] != attr_codes[:-1]),
+            ]
+        )
+        pivoted[id_codes[starts], attr_codes[starts]] = np.maximum.reduceat(
+            values, starts
+        )
+    values = pd.DataFrame(pivoted, index=ids, columns=attr_names.astype(object))
+    df = keys.join(values).reset_index()
     return df
 
 
-def map_colors(df, color_mapper):
+def map_colors(colors, color_mapper):
     """Map the colors using a mapping dictionary. If a color
     is not found in the dict, "Other" is used as default value.
     Note: We lose the `mét.` information in this process.
+    Returns the mapped colors and a mask of the defaulted ones.
     """
-    df = df.copy()
-    df["BodyColorText_mapped"] = (
-        df["BodyColorText"]
-        .str.split(" ")
-        .str.get(0)
-        .map(color_mapper)
-        .fillna("Other")
-    )
-    return df
+    tokens = pd.Series(colors).str.split(" ", n=1).str.get(0).astype("category")
+    # Map the few distinct color words only, then broadcast them by code.
+    # Missing colors have code -1, which picks the appended "Other".
+    colors_mapped = tokens.cat.categories.map(color_mapper).fillna("Other")
+    colors_mapped = np.append(colors_mapped.to_numpy(dtype=object), "Other")
+    colors_mapped = colors_mapped[tokens.cat.codes.to_numpy()]
+    return colors_mapped, colors_mapped == "Other"
 
 
-def check_color_mapping(df):
+def check_color_mapping(defaults):
     """Log the result of the color mapping. Warn if a certain
     color had to be mapped to the default value.
     """
-    df = df.copy()
-    defaults = df[df["BodyColorText_mapped"] == "Other"]["BodyColorText"]
-    defaults = [col for col in defaults.unique()]
     if len(defaults) > 0:
         message = (
             f"CHECK! The following color(s) have been mapped to 'Other': {defaults}"
@@ -111,38 +170,34 @@ def create_make_look_up(df):
     will help to map the makes of the supplier
     data independent of the case.
     """
-    make_look_up = dict(
-        zip(
-            [x.lower() for x in df["make"].unique().astype(str)],
-            list(df["make"].unique().astype(str)),
-        )
-    )
+    makes = np.asarray(df["make"].astype(str).unique(), dtype=str)
+    make_look_up = dict(zip(np.char.lower(makes), makes))
     return make_look_up
 
 
-def map_makes(df, make_look_up):
+def map_makes(makes, make_look_up):
     """Map the makes using the look_up. If a make cannot be
     mapped we use it anyway with an appendix "_SUP". So
     we can decide what to do about it. The make info is to
     important to be defaulted.
+    Returns the mapped makes and a mask of the not mapped ones.
     """
-    df["MakeText_mapped"] = df["MakeText"].str.lower().map(make_look_up)
-    df["MakeText_mapped"] = np.where(
-        df["MakeText_mapped"].isna(),
-        df["MakeText"] + "_SUP",
-        df["MakeText_mapped"],
-    )
-    return df
-
-
-def check_make_mapping(df):
+    # Missing makes stay missing, only the others are looked up
+    has_make = pd.notna(makes)
+    keys = np.char.lower(makes[has_make].astype(str))
+    makes_mapped = np.full(len(makes), np.nan, dtype=object)
+    makes_mapped[has_make] = [make_look_up.get(key) for key in keys]
+    # Only the makes that could not be mapped get the appendix
+    not_mapped = pd.isna(makes_mapped) & has_make
+    makes_mapped[not_mapped] = makes[not_mapped] + "_SUP"
+    return makes_mapped, not_mapped
+
+
+def check_make_mapping(not_mapped):
     """Log the result of the make mapping. Warn if a certain
     make could not be mapped. In this case we will keep the
     original values and not map to a default value.
     """
-    df = df.copy()
-    not_mapped = df[df["MakeText_mapped"].str.endswith("_SUP")]["MakeText"]
-    not_mapped = [col for col in not_mapped.unique()]
     if len(not_mapped) > 0:
         message = (
             f"CHECK! The following make(s) have not been mapped to pre-existing values: {not_mapped}"  # noqa: B950
@@ -152,6 +207,21 @@ def check_make_mapping(df):
     return message
 
 
+def normalize_colors_and_makes(df, color_mapper, make_look_up):
+    """Map the colors and the makes into two new columns, which are
+    added in one go. Also return the colors mapped to the default
+    and the makes that could not be mapped, for the checks above.
+    """
+    colors = df["BodyColorText"].to_numpy(dtype=object)
+    makes = df["MakeText"].to_numpy(dtype=object)
+    colors_mapped, is_default = map_colors(colors, color_mapper)
+    makes_mapped, is_not_mapped = map_makes(makes, make_look_up)
+    df = df.assign(BodyColorText_mapped=colors_mapped, MakeText_mapped=makes_mapped)
+    defaults = pd.unique(colors[is_default]).tolist()
+    not_mapped = pd.unique(makes[is_not_mapped]).tolist()
+    return df, defaults, not_mapped
+
+
 def create_columns_lists(df, df_target, main_mapper):
     """Define which columns have to be deleted, renamed (and how)
     or filled with nan values tor bring the dataframe into the
@@ -171,66 +241,107 @@ def bring_df_to_target_format(
     dataframe in the final format so that it can be integrated with
     the existing data.
     """
-    df = df.copy()
-    df = df.drop(cols_to_delete, axis=1)
-    df = df.rename(columns=cols_to_rename)
-    for col in cols_tbd:
-        df[col] = "TBD"
-    assert df.shape[1] == len(cols_target)
-    df = df.reindex(cols_target, axis=1)
-
-    df["manufacture_year"] = df["manufacture_year"].astype("int")
-    df["mileage"] = df["mileage"].astype("float")
-    df["manufacture_month"] = df["manufacture_month"].astype("int")
+    df = (
+        df.drop(cols_to_delete, axis=1)
+        .rename(columns=cols_to_rename)
+        .assign(**dict.fromkeys(cols_tbd, "TBD"))
+    )
+    missing = set(cols_target) - set(df.columns)
+    extra = set(df.columns) - set(cols_target)
+    assert not missing, f"Missing target columns: {missing}"
+    assert not extra, f"Columns not in target: {extra}"
+    df = df.reindex(cols_target, axis=1).astype(
+        {"manufacture_year": "int64", "mileage": "float64", "manufacture_month": "int8"}
+    )
     return df
 
 
-def write_to_excel(df_tidy, df_normal, df_final):
+def get_column_widths(df, min_width=15):
+    """Return the Excel column widths for the dataframe: the max
+    length of the values or of the column name + 1, with a minimum
+    of `min_width`. Numeric columns are not stringified, for them
+    the length of the extremes is used (close enough for a width).
+    """
+    num_cols = df.select_dtypes(include="number").columns
+    values_as_str = [df.drop(columns=num_cols).astype(str)]
+    if len(num_cols) > 0:
+        values_as_str.append(df[num_cols].agg(["min", "max"]).astype(str))
+    values_as_str = pd.concat(values_as_str)
+    # All-null columns and empty frames have no length, the min width applies
+    len_values = values_as_str.apply(lambda s: s.str.len().max())[df.columns].fillna(0)
+    len_colnames = np.array([len(str(col)) for col in df.columns])
+    return np.maximum.reduce(
+        [
+            np.full(len(df.columns), min_width),
+            len_values.to_numpy(dtype=float) + 1,
+            len_colnames + 1,
+        ]
+    )
+
+
+def write_to_parquet(path, df_final):
+    """Write the final dataframe to parquet. This is the canonical,
+    machine-readable output of the task.
+    """
+    df_final.to_parquet(f"{path}.parquet", index=False)
+
+
+def write_to_excel(path, df_tidy, df_normal, df_final):
     """Write the dataframe to excel, one sheet each for the
     three processing steps. Note: Here I use the xlxswriter engine,
     and this one cannot be changed.
     """
-    path = (
-        f"complete_task_{dt.datetime.strftime(dt.datetime.now(), '%Y-%m-%d-%H-%M-%S')}.xlsx"  # noqa: B950
-    )
-    writer = pd.ExcelWriter(path, engine="xlsxwriter")
-    df_tidy.to_excel(writer, sheet_name="STEP_1", index=False)
-    df_normal.to_excel(writer, sheet_name="STEP_2", index=False)
-    df_final.to_excel(writer, sheet_name="STEP_3", index=False)
+    sheets = {"STEP_1": df_tidy, "STEP_2": df_normal, "STEP_3": df_final}
+    writer = pd.ExcelWriter(f"{path}.xlsx", engine="xlsxwriter")
+    # The sheets are written one after the other on purpose: they share
+    # the workbook (and its string table), which is not thread-safe
+    for sheet_name, df in sheets.items():
+        df.to_excel(writer, sheet_name=sheet_name, index=False)
 
     # Format the color of the two mapped cols in df_normal
     format_m = writer.book.add_format({"fg_color": "#f0f921"})
     writer.sheets["STEP_2"].set_column("AA:Z", None, format_m)
 
     # Setting col witdh to max_len of col values + 1, with a min of 15
-    for sheet, df in zip(writer.sheets.values(), [df_tidy, df_normal, df_final]):
-        for pos, col in enumerate(df):
-            max_len_values = df[col].astype(str).map(len).max()
-            len_colname = len(df[col].name)
-            sheet.set_column(pos, pos, max([15, max_len_values + 1, len_colname + 1]))
-    writer.save()
+    for sheet_name, df in sheets.items():
+        for pos, width in enumerate(get_column_widths(df)):
+            writer.sheets[sheet_name].set_column(pos, pos, width)
+    writer.close()
 
 
-def main(path_sup=PATH_SUP, path_target=PATH_TARGET, path_mappers=PATH_MAPPERS):
+def main(path_sup=PATH_SUP, path_target=PATH_TARGET, excel=False):
     sup_raw = load_json_supplier_data(path_sup)
     logging.info(f"Supplier data loaded with shape: {sup_raw.shape}")
-    target_data = load_excel_target_data(path_target, engine="openpyxl")
-    main_mapper, color_mapper = load_prepared_mapping_dicts(path_mappers)
+    target_data = load_excel_target_data(path_target)
+    main_mapper, color_mapper = load_prepared_mapping_dicts()
     sup_tidy = pivot_attributes_of_supplier_data(sup_raw)
     logging.info(f"Supplier data re-structured, new shape: {sup_tidy.shape}")
-    sup_normal = map_colors(sup_tidy, color_mapper)
-    message_color = check_color_mapping(sup_normal)
-    logging.info(f"Colors mapped into new column.\n {message_color}")
     make_look_up = create_make_look_up(target_data)
-    sup_normal = map_makes(sup_normal, make_look_up)
-    message_make = check_make_mapping(sup_normal)
+    sup_normal, defaults, not_mapped = normalize_colors_and_makes(
+        sup_tidy, color_mapper, make_look_up
+    )
+    message_color = check_color_mapping(defaults)
+    logging.info(f"Colors mapped into new column.\n {message_color}")
+    message_make = check_make_mapping(not_mapped)
     logging.info(f"Makes mapped into new column.\n {message_make}")
     columns_lists = create_columns_lists(sup_normal, target_data, main_mapper)
     sup_final = bring_df_to_target_format(sup_normal, *columns_lists)
     logging.info(f"Supplier data brought to target format, new shape {sup_final.shape}")
-    write_to_excel(sup_tidy, sup_normal, sup_final)
-    logging.info("Success! Written to XLSX file, task complete.")
+    path_out = f"complete_task_{dt.datetime.now():%Y-%m-%d-%H-%M-%S}"
+    write_to_parquet(path_out, sup_final)
+    logging.info("Written to PARQUET file.")
+    if excel:
+        write_to_excel(path_out, sup_tidy, sup_normal, sup_final)
+        logging.info("Written to XLSX file.")
+    logging.info("Success! Task complete.")
 
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Run the data integration task.")
+    parser.add_argument(
+        "--excel",
+        action="store_true",
+        help="also write the XLSX file with one sheet per processing step",
+    )
+    args = parser.parse_args()
+    main(excel=args.excel)
@@ -0,0 +1,44 @@
+"""Prepared mapping dicts for the data integration task.
+(See DEV jupyter notebook for how they have been defined.)
+"""
+
+# Defines which columns of the target data correspond to which
+# columns of the supplier data (None: no corresponding column)
+MAIN_MAPPER = {
+    "carType": "BodyTypeText",  # needs mapping of values
+    "color": "BodyColorText_mapped",  # we lose the "métalisé" information though - MAPPED
+    "condition": "ConditionTypeText",  # needs mapping, tricky see illustrations
+    "currency": None,  # has to be determined by seller / inferred from country of listing
+    "drive": "DriveTypeText",  # needs mapping of values
+    "city": "City",  # seems ok
+    "country": None,  # missing, should be entered by seller / infered from seller address
+    "make": "MakeText_mapped",  # needs mapping of values (e.g. UPPER vs. Upper) - MAPPED
+    "manufacture_year": "FirstRegYear",  # WARNING: these date do not mean the same
+    "mileage": "Km",  # seems ok
+    "mileage_unit": None,  # can be inferred from seller / country of listing
+    "model": "ModelText",  # seems ok
+    "model_variant": "ModelTypeText",  # in the target data some features are concatenated
+    "price_on_request": None,  # must be specified by seller
+    "type": None,  # do we want to allow other values than "car"?
+    "zip": None,  # missing, should be entered by seller / infered from seller address
+    "manufacture_month": "FirstRegMonth",  # see again the WARNING from above
+    "fuel_consumption_unit": "ConsumptionTotalText",  # can be inferred, maybe with a regex
+}
+
+# Maps the (german) color words of the supplier data to english
+COLOR_MAPPER = {
+    "weiss": "White",
+    "blau": "Blue",
+    "schwarz": "Black",
+    "silber": "Silver",
+    "braun": "Brown",
+    "rot": "Red",
+    "anthrazit": "Gray",
+    "grau": "Gray",
+    "grün": "Green",
+    "beige": "Beige",
+    "gelb": "Yellow",
+    "orange": "Orange",
+    "bordeaux": "Purple",
+    "gold": "Gold",
+}